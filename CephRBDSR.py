@@ -50,11 +50,119 @@ import xs_errors
 import vhdutil
 import os
 import json
+import subprocess
+import threading
 import time
 import re
 import datetime
+import uuid
 from lock import Lock
 
+# Optional streaming JSON parser - lets the CLI scan fallback parse rbd
+# output straight off the pipe instead of buffering the whole document
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Optional C-backed JSON decoder - rbd ls/ceph df output can run to hundreds
+# of KB on large clusters and orjson decodes it several times faster than
+# stdlib json while producing identical dict/list structures
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# Native Ceph bindings - when available we keep a single authenticated cluster
+# connection per SR so stat/scan/snapshot operations reuse it instead of paying
+# fork/exec + MON handshake for every ceph/rbd CLI invocation. The CLI remains
+# as a fallback and is still required for kernel map/unmap operations.
+try:
+    import rados
+    import rbd as librbd
+except ImportError:
+    rados = None
+    librbd = None
+
+# Thread pool used to overlap per-image cluster round-trips during scan;
+# librados releases the GIL while waiting on the OSDs so threads give a
+# near-linear speedup. Not available on older python installs, in which
+# case we simply probe serially.
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+# Cap on concurrent image probes so a scan of a large pool doesn't starve
+# other MON/OSD traffic; overridable for clusters that want more or less
+# concurrency without patching the driver. 0 disables the worker pool
+# entirely (everything runs serially); malformed values fall back to the
+# default rather than breaking the driver
+try:
+    SCAN_MAX_WORKERS = max(0, int(os.environ.get('CEPHRBDSR_PARALLEL', '32')))
+except ValueError:
+    SCAN_MAX_WORKERS = 32
+
+# Compiled once at import - scan() validates one UUID per RBD image in the
+# pool, so recompiling the pattern per call would be linear waste
+UUID_REGEX = re.compile(
+    r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$',
+    re.IGNORECASE
+)
+
+# Bytes per megabyte - the rbd CLI expresses image sizes in MB
+MB = 1 << 20
+
+# How long cached pool statistics stay valid - long enough to coalesce the
+# bursts of stat/quota reads within one SR operation, short enough that
+# consecutive operations still see fresh numbers
+STATS_CACHE_TTL = 2.0
+
+# How long the host-wide mapped-devices table stays valid; attach/detach
+# invalidate it explicitly, the TTL only bounds staleness against maps
+# made outside this driver
+MAPPED_CACHE_TTL = 5.0
+
+
+# Per-VDI scan logging is useful day-to-day but costs a string format and
+# a syslog write for every image; on pools with thousands of VDIs set
+# CEPHRBDSR_QUIET_SCAN to drop the chatter (error logs are unaffected)
+SCAN_VERBOSE = os.environ.get('CEPHRBDSR_QUIET_SCAN', '') == ''
+
+
+def _smlog(fmt, *args):
+    """SMlog with deferred formatting for per-VDI scan chatter - the
+    %-format only runs when the message will actually be written"""
+    if SCAN_VERBOSE:
+        util.SMlog(fmt % args)
+
+
+def _json_pread(cmd):
+    """Run a command that emits JSON and parse its output directly.
+
+    Unlike pread2 + loads this hands the raw bytes straight to the JSON
+    decoder without pread2's intermediate buffering and logging, so the
+    full output text isn't held alongside the parsed result - relevant on
+    dom0 where memory is tight and ceph df / rbd listings can be large.
+    Returns None when the command produced no output."""
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    output = proc.stdout.read()
+    if proc.wait() != 0:
+        raise Exception("%s failed with rc %d" % (cmd[0], proc.returncode))
+    if not output.strip():
+        return None
+    return _json_loads(output)
+
+
+def _read_sysfs(path):
+    """Read and strip a single sysfs attribute file"""
+    f = open(path)
+    try:
+        return f.read().strip()
+    finally:
+        f.close()
+
 # Driver capabilities - Ceph RBD supports advanced features
 CAPABILITIES = [
     "SR_PROBE",              # Can probe for existing pools
@@ -130,10 +238,39 @@ class CephRBDSR(SR.SR):
         # If custom prefix is set and doesn't end with a hyphen, add one
         if self.prefix and self.prefix != '' and not self.prefix.endswith('-'):
             self.prefix += '-'
+
+        # Image/snapshot name prefixes and the udev device root, built once -
+        # VDI construction and the scan loop would otherwise re-concatenate
+        # them for every VDI
+        self._image_prefix = self.prefix + self.RBD_PREFIX
+        self._snap_prefix = self.prefix + self.SNAPSHOT_PREFIX
+        self._dev_root = "/dev/rbd/" + self.pool + "/"
         
         # Validate Ceph configuration file exists
         if not os.path.exists(self.ceph_conf):
             raise xs_errors.XenError('ConfigParameterInvalid', opterr='Ceph config file not found: %s' % self.ceph_conf)
+
+        # The authentication arguments never change after load - build them
+        # once so each command construction is a plain concatenation instead
+        # of re-running the same branch sequence
+        auth = []
+        if self.ceph_conf:
+            auth.extend(['-c', self.ceph_conf])
+        if self.ceph_user:
+            auth.extend(['--id', self.ceph_user])
+        if self.keyring:
+            auth.extend(['-k', self.keyring])
+        if self.mon_host:
+            auth.extend(['-m', self.mon_host])
+
+        # Full command prefixes, assembled once - every CLI call is then a
+        # single list concatenation instead of rebuilding the argument list
+        self._ceph_prefix = ['ceph'] + auth
+        self._rbd_prefix = ['rbd'] + auth
+        if self.pool:
+            self._rbd_pool_prefix = ['rbd', '--pool', self.pool] + auth
+        else:
+            self._rbd_pool_prefix = self._rbd_prefix
         
         # Set up paths and properties
         self.path = "/dev/rbd/%s" % self.pool  # Kernel RBD device path
@@ -141,8 +278,68 @@ class CephRBDSR(SR.SR):
         
         # Initialize locking
         self.lock = Lock("CephRBDSR", sr_uuid)
-        
+
+        # Short-lived cache for pool statistics, see _get_cached_stats()
+        self._stats_cache = {}
+        self._stats_lock = threading.Lock()
+
+        # Host-wide mapped-devices table, see _get_mapped_devices()
+        self._mapped_cache = None
+        self._mapped_cache_time = 0
+
+        # Lazily resolved sm_config key for this host, see _get_host_key()
+        self._host_key = None
+
+        # Shared worker pool for parallel fan-outs (scan probes, bulk
+        # operations). Created once per SR so each operation doesn't pay
+        # pool creation/teardown; threads are only spawned on demand.
+        self._executor = None
+        if ThreadPoolExecutor is not None and SCAN_MAX_WORKERS > 0:
+            self._executor = ThreadPoolExecutor(max_workers=SCAN_MAX_WORKERS)
+
+        # Open a long-lived cluster connection when the python bindings are
+        # available - all subsequent operations share the already-authenticated
+        # handle instead of spawning a new process per command
+        self.cluster = None
+        self.ioctx = None
+        self.rbd = None
+        if rados is not None:
+            try:
+                # Honour the same optional overrides the CLI commands get
+                # via the precomputed command prefixes
+                conf = {}
+                if self.keyring:
+                    conf['keyring'] = self.keyring
+                if self.mon_host:
+                    conf['mon_host'] = self.mon_host
+                self.cluster = rados.Rados(conffile=self.ceph_conf, rados_id=self.ceph_user, conf=conf)
+                # Bounded connect so an unreachable cluster degrades to the
+                # CLI fallback instead of hanging the SM call
+                self.cluster.connect(timeout=30)
+                self.ioctx = self.cluster.open_ioctx(self.pool)
+                self.rbd = librbd.RBD()
+                util.SMlog("CephRBDSR: connected to cluster via librados (pool=%s)" % self.pool)
+            except Exception as e:
+                util.SMlog("CephRBDSR: librados unavailable, falling back to CLI: %s" % str(e))
+                self._close_cluster()
+
         util.SMlog("CephRBDSR loaded successfully: pool=%s" % self.pool)
+
+    def _close_cluster(self):
+        """Close the librados connection if one is open"""
+        if self.ioctx is not None:
+            try:
+                self.ioctx.close()
+            except Exception as e:
+                util.SMlog("Warning: Failed to close ioctx: %s" % str(e))
+            self.ioctx = None
+        if self.cluster is not None:
+            try:
+                self.cluster.shutdown()
+            except Exception as e:
+                util.SMlog("Warning: Failed to shut down cluster handle: %s" % str(e))
+            self.cluster = None
+        self.rbd = None
     
     def create(self, sr_uuid, size):
         """Create new Ceph RBD storage repository"""
@@ -170,15 +367,31 @@ class CephRBDSR(SR.SR):
         
         # First scan for any existing VDIs
         self.scan(sr_uuid)
-        
-        # Delete all VDIs in this SR
-        for vdi_uuid in list(self.vdis.keys()):
-            vdi = self.vdis[vdi_uuid]
+
+        # Delete all VDIs in this SR. Defer stats updates so the loop doesn't
+        # pay one MON query + XAPI write per VDI - everything is published once
+        # at the end instead.
+        def _delete_one(vdi):
             try:
-                vdi.delete(sr_uuid, vdi_uuid)
-                util.SMlog("Deleted VDI %s" % vdi_uuid)
+                vdi.delete(sr_uuid, vdi.uuid)
+                util.SMlog("Deleted VDI %s" % vdi.uuid)
             except Exception as e:
-                util.SMlog("Warning: Failed to delete VDI %s: %s" % (vdi_uuid, str(e)))
+                util.SMlog("Warning: Failed to delete VDI %s: %s" % (vdi.uuid, str(e)))
+
+        # Snapshot the VDI objects (not a keys copy plus per-key lookups) so
+        # the dict can be mutated by each delete while we iterate; a VDI
+        # whose deletion fails stays behind in self.vdis
+        vdis_to_delete = list(self.vdis.values())
+        self._begin_bulk_stats()
+        try:
+            if self._executor is not None and len(vdis_to_delete) > 1:
+                # Each deletion is an independent cluster round-trip, overlap them
+                list(self._executor.map(_delete_one, vdis_to_delete))
+            else:
+                for vdi in vdis_to_delete:
+                    _delete_one(vdi)
+        finally:
+            self._end_bulk_stats(sr_uuid)
         
         # Note: We don't delete the Ceph pool as it may contain other data
         # and pools are typically managed separately from XCP-ng
@@ -189,9 +402,13 @@ class CephRBDSR(SR.SR):
         """Attach Ceph RBD storage repository"""
         util.SMlog("Attaching CephRBDSR %s" % sr_uuid)
         
-        # Verify Ceph connectivity
-        self._test_ceph_connectivity()
-        
+        # Verify Ceph connectivity. When librados is in use the load()
+        # handshake already authenticated and opened the pool, so a further
+        # probe would just repeat the same MON round-trip; only the CLI
+        # fallback needs an explicit check
+        if self.cluster is None:
+            self._test_ceph_connectivity()
+
         # Update pool statistics - this will call _db_update()
         self.stat(sr_uuid)
         
@@ -202,15 +419,50 @@ class CephRBDSR(SR.SR):
         util.SMlog("Detaching CephRBDSR %s" % sr_uuid)
         
         # Ensure all VDIs are detached
-        for vdi_uuid in self.vdis:
-            vdi = self.vdis[vdi_uuid]
-            if vdi.attached:
-                util.SMlog("Force detaching VDI %s" % vdi_uuid)
-                try:
-                    vdi.detach(sr_uuid, vdi_uuid)
-                except Exception as e:
-                    util.SMlog("Warning: Failed to detach VDI %s: %s" % (vdi_uuid, str(e)))
-        
+        def _detach_one(item):
+            vdi_uuid, vdi = item
+            util.SMlog("Force detaching VDI %s" % vdi_uuid)
+            try:
+                vdi.detach(sr_uuid, vdi_uuid)
+            except Exception as e:
+                util.SMlog("Warning: Failed to detach VDI %s: %s" % (vdi_uuid, str(e)))
+
+        def _unmap_one(item):
+            vdi_uuid, vdi = item
+            util.SMlog("Force detaching VDI %s" % vdi_uuid)
+            if not vdi.mapped_path_known:
+                util.SMlog("WARNING: Mapped path not known, this is a bug!")
+                return False
+            vdi.device_path = vdi.mapped_path
+            try:
+                vdi._unmap_device()
+                return True
+            except Exception as e:
+                util.SMlog("Warning: Failed to unmap RBD device %s: %s" % (vdi.device_path, str(e)))
+                return False
+
+        attached = [(u, v) for u, v in self.vdis.items() if v.attached]
+        if self._executor is not None and len(attached) > 1:
+            # Only the kernel unmaps overlap - they are independent
+            # subprocesses. The sm_config cleanup goes through XAPI on the
+            # shared session, whose transport caches a single connection
+            # and is not safe for concurrent requests, so it runs serially
+            # once the unmaps are done
+            unmapped = list(self._executor.map(_unmap_one, attached))
+            for (vdi_uuid, vdi), ok in zip(attached, unmapped):
+                if ok:
+                    vdi._clean_sm_config_device_path()
+        else:
+            for item in attached:
+                _detach_one(item)
+
+        # Drop the worker pool and persistent cluster connection, nothing
+        # needs them past this point
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self._close_cluster()
+
         util.SMlog("CephRBDSR detached successfully")
     
     def scan(self, sr_uuid):
@@ -222,50 +474,55 @@ class CephRBDSR(SR.SR):
         
         try:
             # List all RBD images in the pool
-            cmd = self._build_rbd_cmd(['ls', '-l', '--format', 'json'])
-            output = util.pread2(cmd)
-            
-            if output.strip():
-                rbd_images = json.loads(output)
-                
+            rbd_images = self._list_rbd_images()
+
+            if rbd_images:
+                # Hoist loop invariants into locals - keeps the hot loop off
+                # attribute lookups and repeated len() calls
+                image_prefix = self._image_prefix
+                image_prefix_len = len(image_prefix)
+                snap_prefix_len = len(self._snap_prefix)
+                vdis = self.vdis
+                virtual_allocation = 0
+
                 for image_info in rbd_images:
                     image_name = image_info['image']
-                    
+
                     # Check if this RBD image belongs to our SR (has VDI prefix and proper UUID)
-                    if image_name.startswith(self.prefix + self.RBD_PREFIX):
+                    if image_name.startswith(image_prefix):
                         try:
                             if ('snapshot' in image_info):
                                 snapshot_id = image_info['snapshot']
-                                vdi_uuid = snapshot_id[len(self.prefix + self.SNAPSHOT_PREFIX):]
+                                vdi_uuid = snapshot_id[snap_prefix_len:]
                                 if (self._is_valid_uuid(vdi_uuid)):
-                                    parent_id = image_info['image']
+                                    parent_id = image_name
                                     vdi = self.vdi(vdi_uuid)
                                     vdi._load_from_rbd_info(image_info)
                                     # If the snapshot_of is missing, fix it
                                     if (vdi.snapshot_of is None):
-                                        vdi.snapshot_of = parent_id[len(self.prefix + self.RBD_PREFIX):]
+                                        vdi.snapshot_of = parent_id[image_prefix_len:]
                                         util.SMlog("Fixed missing snapshot_of for VDI %s: set to %s" % (vdi_uuid, vdi.snapshot_of))
-                                    self.vdis[snapshot_id] = vdi
-                                    self.virtual_allocation += vdi.size
-                                    util.SMlog("Found VDI snapshot of %s: %s (size: %d)" % (parent_id, snapshot_id, vdi.size))
+                                    vdis[snapshot_id] = vdi
+                                    virtual_allocation += vdi.size
+                                    _smlog("Found VDI snapshot of %s: %s (size: %d)", parent_id, snapshot_id, vdi.size)
                             else:
-                                vdi_uuid = image_name[len(self.prefix + self.RBD_PREFIX):]
+                                vdi_uuid = image_name[image_prefix_len:]
                                 if (self._is_valid_uuid(vdi_uuid)):
                                     vdi = self.vdi(vdi_uuid)
                                     vdi._load_from_rbd_info(image_info)
-                                    self.vdis[vdi_uuid] = vdi
-                                    self.virtual_allocation += vdi.size
-                                    util.SMlog("Found VDI: %s (size: %d)" % (vdi_uuid, vdi.size))
+                                    vdis[vdi_uuid] = vdi
+                                    virtual_allocation += vdi.size
+                                    _smlog("Found VDI: %s (size: %d)", vdi_uuid, vdi.size)
 
                         except Exception as e:
                             util.SMlog("Error loading VDI %s: %s" % (vdi_uuid, str(e)))
 
                     else:
-                        util.SMlog("Found unknown RBD image %s - does not match SR prefix, ignoring" % image_name)
+                        _smlog("Found unknown RBD image %s - does not match SR prefix, ignoring", image_name)
                         # Consider its size as it's also using space in the pool
-                        size = image_info.get('size', 0)
-                        self.virtual_allocation += size
+                        virtual_allocation += image_info.get('size', 0)
 
+                self.virtual_allocation = virtual_allocation
                 util.SMlog("Scan complete: found %d VDIs, total allocation: %d" % (len(self.vdis), self.virtual_allocation))
             
         except Exception as e:
@@ -278,18 +535,101 @@ class CephRBDSR(SR.SR):
         """Create VDI object for given UUID"""
         return CephRBDVDI(self, uuid)
 
-    def stat(self, sr_uuid):
-        """Update SR capacity/usage statistics and sync with XAPI."""
-        util.SMlog("CephRBDSR.stat: updating statistics for SR %s" % sr_uuid)
-        
+    def _probe_image(self, image_name):
+        """Collect info for a single RBD image and its snapshots.
+
+        Returns a list of dicts in the same shape as 'rbd ls -l' JSON output:
+        one entry for the image itself plus one per snapshot."""
+        entries = []
+        try:
+            # Read-only open skips watcher registration and the exclusive-lock
+            # handshake, saving a cluster round-trip per probed image
+            img = librbd.Image(self.ioctx, image_name, read_only=True)
+            try:
+                entries.append({'image': image_name, 'size': img.size()})
+                for snap in img.list_snaps():
+                    entries.append({'image': image_name, 'snapshot': snap['name'], 'size': snap['size']})
+            finally:
+                img.close()
+        except Exception as e:
+            util.SMlog("Failed to inspect RBD image %s: %s" % (image_name, str(e)))
+        return entries
+
+    def _list_rbd_images(self):
+        """List all RBD images and snapshots in the pool.
+
+        Uses librbd over the persistent cluster connection when available
+        (single in-process listing instead of a process spawn per scan),
+        falling back to the rbd CLI otherwise. Output format matches the
+        'rbd ls -l --format json' structure the scan logic expects."""
+        if self.rbd is not None:
+            image_names = self.rbd.list(self.ioctx)
+            images = []
+            # Handing work to the pool has its own dispatch cost - for a
+            # handful of images the serial loop wins
+            if self._executor is not None and len(image_names) >= 4:
+                # Each probe is an independent OSD round-trip, fan them out so
+                # scan latency is bounded by the slowest probe rather than the sum
+                for entries in self._executor.map(self._probe_image, image_names):
+                    images.extend(entries)
+            else:
+                for image_name in image_names:
+                    images.extend(self._probe_image(image_name))
+            return images
+
+        cmd = self._build_rbd_cmd(['ls', '-l', '--format', 'json'])
+        if ijson is not None:
+            # Stream-parse straight from the pipe - on large pools this avoids
+            # holding the full multi-megabyte JSON text alongside the parsed
+            # list, and parsing starts before rbd finishes writing
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+            images = list(ijson.items(proc.stdout, 'item'))
+            if proc.wait() != 0:
+                raise Exception("rbd ls failed with rc %d" % proc.returncode)
+            return images
+        output = util.pread2(cmd)
+        if not output.strip():
+            return []
+        return _json_loads(output)
+
+    def _refresh_physical(self, force_db=False):
+        """Refresh physical size/utilisation from the pool.
+
+        Single code path shared by stat/update/_updateStats so the pool is
+        only queried in one place; the XAPI database is written only when a
+        value actually changed (or when force_db is set)."""
         s = self._get_pool_stats()
-        total = s.get('total', 0)
-        used = s.get('used', 0)
+        total = int(s.get('total', 0))
+        used = int(s.get('used', 0))
 
-        # Always update physical statistics from Ceph
+        if total <= 0:
+            total = 1
+            used = 0
+
+        changed = (getattr(self, 'physical_size', None) != total or
+                   getattr(self, 'physical_utilisation', None) != used)
         self.physical_size = total
         self.physical_utilisation = used
 
+        if changed or force_db:
+            self._db_update()
+
+    def _begin_bulk_stats(self):
+        """Start deferring stats updates - used by bulk operations so each
+        per-VDI change doesn't trigger its own MON query and XAPI write"""
+        self._deferred_alloc_delta = 0
+        self._defer_stats = True
+
+    def _end_bulk_stats(self, sr_uuid):
+        """Publish all deferred stats updates in one go"""
+        self._defer_stats = False
+        self._updateStats(sr_uuid, self._deferred_alloc_delta)
+        self._deferred_alloc_delta = 0
+
+    def stat(self, sr_uuid):
+        """Update SR capacity/usage statistics and sync with XAPI."""
+        util.SMlog("CephRBDSR.stat: updating statistics for SR %s" % sr_uuid)
+
         # Preserve existing virtual allocation if it's valid, otherwise get from XAPI
         if not hasattr(self, 'virtual_allocation') or self.virtual_allocation is None:
             self.virtual_allocation = 0
@@ -297,17 +637,18 @@ class CephRBDSR(SR.SR):
                 try:
                     valloc = int(self.session.xenapi.SR.get_virtual_allocation(self.sr_ref))
                     self.virtual_allocation = valloc
+                    self._valloc_synced = True
                     util.SMlog("CephRBDSR.stat: got virtual_allocation from XAPI: %d" % valloc)
                 except Exception as e:
                     util.SMlog("CephRBDSR.stat: failed to get virtual_allocation from XAPI: %s" % str(e))
 
+        # Refresh physical statistics from Ceph and push everything to XAPI
+        self._refresh_physical(force_db=True)
+
         free = max(0, self.physical_size - self.physical_utilisation)
-        util.SMlog("CephRBDSR.stat: phys_size=%d phys_util=%d virt_alloc=%d free=%d" % 
+        util.SMlog("CephRBDSR.stat: phys_size=%d phys_util=%d virt_alloc=%d free=%d" %
                    (self.physical_size, self.physical_utilisation, self.virtual_allocation, free))
 
-        # Update XAPI database with new statistics
-        self._db_update()
-
     def update(self, sr_uuid):
         """Update SR statistics (same as stat for CephRBD)."""
         util.SMlog("CephRBDSR.update: updating SR %s" % sr_uuid)
@@ -316,74 +657,120 @@ class CephRBDSR(SR.SR):
     def _updateStats(self, sr_uuid, virtAllocDelta=0):
         """Update SR statistics with virtual allocation delta"""
         util.SMlog("CephRBDSR._updateStats: delta=%d" % virtAllocDelta)
-        
+
+        if getattr(self, '_defer_stats', False):
+            # Bulk operation in progress - just accumulate the delta, the
+            # caller publishes everything once at the end. The lock keeps the
+            # accumulation safe when bulk work is fanned out across threads.
+            with self._stats_lock:
+                self._deferred_alloc_delta += virtAllocDelta
+            return
+
         # Update virtual allocation
         if virtAllocDelta != 0:
             if self.sr_ref:
-                try:
-                    # Get current virtual allocation from XAPI and add delta
-                    valloc = int(self.session.xenapi.SR.get_virtual_allocation(self.sr_ref))
-                    self.virtual_allocation = valloc + virtAllocDelta
-                    if (self.virtual_allocation < 0):
-                        self.virtual_allocation = 0
-                    util.SMlog("CephRBDSR._updateStats: XAPI virtual_allocation %d + delta %d = %d" % 
-                               (valloc, virtAllocDelta, self.virtual_allocation))
-                except Exception as e:
-                    util.SMlog("Warning: Could not get virtual allocation from XAPI: %s" % str(e))
-                    # Fall back to our own tracking
-                    if not hasattr(self, 'virtual_allocation'):
-                        self.virtual_allocation = 0
+                if getattr(self, '_valloc_synced', False):
+                    # Already synced with XAPI earlier in this operation -
+                    # apply the delta locally instead of paying another
+                    # XML-RPC round-trip; _db_update pushes the result back
                     self.virtual_allocation += virtAllocDelta
                     if (self.virtual_allocation < 0):
                         self.virtual_allocation = 0
-                    util.SMlog("CephRBDSR._updateStats: local virtual_allocation + delta %d = %d" % 
+                    util.SMlog("CephRBDSR._updateStats: local virtual_allocation + delta %d = %d (synced)" %
                                (virtAllocDelta, self.virtual_allocation))
-        
-        # Always refresh physical statistics from pool
-        s = self._get_pool_stats()
-        total = s.get('total', 0)
-        used = s.get('used', 0)
-        
-        if total <= 0:
-            total = 1
-            used = 0
-            
-        self.physical_size = int(total)
-        self.physical_utilisation = int(used)
+                else:
+                    try:
+                        # Get current virtual allocation from XAPI and add delta
+                        valloc = int(self.session.xenapi.SR.get_virtual_allocation(self.sr_ref))
+                        self.virtual_allocation = valloc + virtAllocDelta
+                        if (self.virtual_allocation < 0):
+                            self.virtual_allocation = 0
+                        self._valloc_synced = True
+                        util.SMlog("CephRBDSR._updateStats: XAPI virtual_allocation %d + delta %d = %d" %
+                                   (valloc, virtAllocDelta, self.virtual_allocation))
+                    except Exception as e:
+                        util.SMlog("Warning: Could not get virtual allocation from XAPI: %s" % str(e))
+                        # Fall back to our own tracking
+                        if not hasattr(self, 'virtual_allocation'):
+                            self.virtual_allocation = 0
+                        self.virtual_allocation += virtAllocDelta
+                        if (self.virtual_allocation < 0):
+                            self.virtual_allocation = 0
+                        util.SMlog("CephRBDSR._updateStats: local virtual_allocation + delta %d = %d" %
+                                   (virtAllocDelta, self.virtual_allocation))
         
         # Ensure we have virtual allocation set
         if not hasattr(self, 'virtual_allocation'):
             self.virtual_allocation = 0
-        
-        util.SMlog("CephRBDSR._updateStats: final stats phys_size=%d phys_util=%d virt_alloc=%d" % 
+
+        # Always refresh physical statistics from pool and publish to XAPI
+        self._refresh_physical(force_db=True)
+
+        util.SMlog("CephRBDSR._updateStats: final stats phys_size=%d phys_util=%d virt_alloc=%d" %
                    (self.physical_size, self.physical_utilisation, self.virtual_allocation))
-        
-        # Update XAPI database
-        self._db_update()
+
+        # A non-zero delta means pool usage changed - make sure the next
+        # operation re-reads the statistics instead of seeing stale values
+        if virtAllocDelta != 0:
+            self._invalidate_stats_cache()
     
     def _test_ceph_connectivity(self):
         """Test connectivity to Ceph cluster"""
+        if self.cluster is not None:
+            # Single MON round-trip on the persistent connection - the pool was
+            # already proven accessible when load() opened the ioctx
+            try:
+                self.cluster.mon_command(json.dumps({"prefix": "status", "format": "json"}), b'')
+                util.SMlog("Successfully connected to Ceph cluster via librados")
+                return
+            except Exception as e:
+                raise xs_errors.XenError('SRUnavailable',
+                                       opterr='Cannot connect to Ceph cluster: %s' % str(e))
         try:
-            # Test basic Ceph connectivity
+            # Test basic Ceph connectivity. A single health query is enough -
+            # enumerating the whole pool with rbd ls here would only re-prove
+            # the same reachability at O(#images) cost.
             cmd = self._build_ceph_cmd(['health'])
             output = util.pread2(cmd)
             util.SMlog("Ceph cluster health: %s" % output.strip())
-            
-            # Test pool access
-            cmd = self._build_rbd_cmd(['ls', self.pool])
-            util.pread2(cmd)
-            util.SMlog("Successfully connected to Ceph pool: %s" % self.pool)
-            
+
         except Exception as e:
             raise xs_errors.XenError('SRUnavailable',
                                    opterr='Cannot connect to Ceph cluster: %s' % str(e))
     
+    def _get_cached_stats(self, key, fetch):
+        """Return cached pool statistics for key, re-fetching after the TTL.
+
+        create/stat/_updateStats all re-read pool statistics within a single
+        SR operation and each read is a MON round-trip, so bursts of reads
+        are coalesced through this small per-instance cache."""
+        cached = self._stats_cache.get(key)
+        if cached is not None and time.time() - cached[0] < STATS_CACHE_TTL:
+            return cached[1]
+        value = fetch()
+        self._stats_cache[key] = (time.time(), value)
+        return value
+
+    def _invalidate_stats_cache(self):
+        """Drop cached pool statistics after an operation that changed usage"""
+        self._stats_cache.clear()
+
     def _get_pool_quota(self):
+        """Check if pool has quota set and return quota-based statistics (cached)."""
+        return self._get_cached_stats('quota', self._fetch_pool_quota)
+
+    def _fetch_pool_quota(self):
         """Check if pool has quota set and return quota-based statistics."""
         try:
-            cmd = self._build_ceph_cmd(['osd', 'pool', 'get-quota', self.pool, '--format', 'json'])
-            out = util.pread2(cmd)
-            quota_data = json.loads(out)
+            if self.cluster is not None:
+                ret, out, errs = self.cluster.mon_command(
+                    json.dumps({"prefix": "osd pool get-quota", "pool": self.pool, "format": "json"}), b'')
+                if ret != 0:
+                    raise Exception("mon_command get-quota failed: %s" % errs)
+                quota_data = _json_loads(out)
+            else:
+                cmd = self._build_ceph_cmd(['osd', 'pool', 'get-quota', self.pool, '--format', 'json'])
+                quota_data = _json_pread(cmd) or {}
             
             # Check if byte quota is set (quota_max_bytes > 0)
             quota_max_bytes = int(quota_data.get('quota_max_bytes', 0))
@@ -411,6 +798,10 @@ class CephRBDSR(SR.SR):
             return None
 
     def _get_pool_stats(self):
+        """Get statistics for the Ceph pool in bytes (cached)."""
+        return self._get_cached_stats('stats', self._fetch_pool_stats)
+
+    def _fetch_pool_stats(self):
         """Get statistics for the Ceph pool (bytes)."""
         try:
             # First check if the pool has a quota set
@@ -421,9 +812,15 @@ class CephRBDSR(SR.SR):
             
             # Fall back to cluster capacity if no quota is set
             util.SMlog("CephRBDSR: no pool quota set, using cluster capacity")
-            cmd = self._build_ceph_cmd(['df', 'detail', '-f', 'json'])
-            out = util.pread2(cmd)
-            data = json.loads(out)
+            if self.cluster is not None:
+                ret, out, errs = self.cluster.mon_command(
+                    json.dumps({"prefix": "df", "detail": "detail", "format": "json"}), b'')
+                if ret != 0:
+                    raise Exception("mon_command df failed: %s" % errs)
+                data = _json_loads(out)
+            else:
+                cmd = self._build_ceph_cmd(['df', 'detail', '-f', 'json'])
+                data = _json_pread(cmd) or {}
 
             for p in data.get('pools', []):
                 if p.get('name') == self.pool:
@@ -443,66 +840,87 @@ class CephRBDSR(SR.SR):
     
     def _build_ceph_cmd(self, args):
         """Build ceph command with authentication parameters"""
-        cmd = ['ceph']
-        
-        # Add configuration file
-        if self.ceph_conf:
-            cmd.extend(['-c', self.ceph_conf])
-        
-        # Add user authentication
-        if self.ceph_user:
-            cmd.extend(['--id', self.ceph_user])
-        
-        # Add keyring if specified
-        if self.keyring:
-            cmd.extend(['-k', self.keyring])
-        
-        # Add monitor hosts if specified
-        if self.mon_host:
-            cmd.extend(['-m', self.mon_host])
-        
-        cmd.extend(args)
-        return cmd
-    
-    def _build_rbd_cmd(self, args):
-        """Build rbd command with authentication parameters"""
-        cmd = ['rbd']
-        
-        # Add pool specification
-        if self.pool and len(args) > 0 and not any('--pool' in str(arg) for arg in args):
-            cmd.extend(['--pool', self.pool])
-        
-        # Add configuration file
-        if self.ceph_conf:
-            cmd.extend(['-c', self.ceph_conf])
-        
-        # Add user authentication  
-        if self.ceph_user:
-            cmd.extend(['--id', self.ceph_user])
-        
-        # Add keyring if specified
-        if self.keyring:
-            cmd.extend(['-k', self.keyring])
-        
-        # Add monitor hosts if specified
-        if self.mon_host:
-            cmd.extend(['-m', self.mon_host])
-        
-        cmd.extend(args)
-        return cmd
+        return self._ceph_prefix + args
+
+    def _build_rbd_cmd(self, args, inject_pool=True):
+        """Build rbd command with authentication parameters.
+
+        The pool specification is injected by default; callers addressing
+        a different (or no) pool pass inject_pool=False instead of
+        supplying their own --pool for us to detect."""
+        if inject_pool:
+            return self._rbd_pool_prefix + args
+        return self._rbd_prefix + args
     
     def _is_valid_uuid(self, uuid_str):
         """Validate UUID format"""
-        uuid_pattern = re.compile(
-            r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$',
-            re.IGNORECASE
-        )
-        return bool(uuid_pattern.match(uuid_str))
+        # Length check first - rejects the common non-VDI image names
+        # before the regex engine is even entered
+        if len(uuid_str) != 36:
+            return False
+        return bool(UUID_REGEX.match(uuid_str))
+
+    def _get_mapped_devices(self):
+        """Return {(image, snap): device} for every RBD of our pool mapped
+        on this host.
+
+        One sysfs walk serves all the per-VDI mapping checks within an
+        operation - bulk delete/detach would otherwise re-read
+        /sys/bus/rbd/devices once per VDI. attach/detach invalidate the
+        cache via _invalidate_mapped_cache(); the TTL only bounds staleness
+        against maps made outside this driver."""
+        now = time.time()
+        if self._mapped_cache is not None and now - self._mapped_cache_time < MAPPED_CACHE_TTL:
+            return self._mapped_cache
+
+        mapping = {}
+        sysfs = CephRBDVDI.RBD_SYSFS_PATH
+        if os.path.isdir(sysfs):
+            try:
+                for dev_id in os.listdir(sysfs):
+                    dev_dir = os.path.join(sysfs, dev_id)
+                    try:
+                        if _read_sysfs(os.path.join(dev_dir, 'pool')) != self.pool:
+                            continue
+                        name = _read_sysfs(os.path.join(dev_dir, 'name'))
+                        snap = _read_sysfs(os.path.join(dev_dir, 'current_snap'))
+                        if snap == '-':
+                            # Kernel reports '-' for a plain (non-snapshot) map
+                            snap = ''
+                        mapping[(name, snap)] = '/dev/rbd%s' % dev_id
+                    except (IOError, OSError):
+                        # Device went away mid-scan, skip it
+                        continue
+            except OSError as e:
+                util.SMlog("Failed to scan %s: %s" % (sysfs, str(e)))
+
+        self._mapped_cache = mapping
+        self._mapped_cache_time = now
+        return mapping
+
+    def _get_host_key(self):
+        """Return the sm_config key under which this host stores device paths.
+
+        The host ref never changes within a process, so resolve it through
+        XAPI once instead of paying one RPC per VDI - scan calls
+        _load_if_exists for every VDI in the pool."""
+        if self._host_key is None:
+            host_ref = self.session.xenapi.host.get_by_uuid(util.get_this_host())
+            self._host_key = "host_%s_device_path" % host_ref
+        return self._host_key
+
+    def _invalidate_mapped_cache(self):
+        """Force the next _get_mapped_devices() to re-read sysfs"""
+        self._mapped_cache = None
+        self._mapped_cache_time = 0
 
 
 class CephRBDVDI(VDI.VDI):
     """Ceph RBD VDI implementation"""
-    
+
+    # Kernel RBD driver exposes every locally mapped image here
+    RBD_SYSFS_PATH = "/sys/bus/rbd/devices"
+
     def __init__(self, sr, uuid):
         # On first sight it may appear as this is identical to attached, but it's not, attached is a state when VDI is attached in XAPI
         # Mapped is a state when RBD image is mapped in the kernel. Ideally these should be in sync, but in case of crashes or bugs they might differ
@@ -514,24 +932,36 @@ class CephRBDVDI(VDI.VDI):
         self.snapshot_of = None
         self.is_protected = False
         self.is_a_snapshot = False
+        # XAPI ref for this VDI, resolved lazily via _get_vdi_ref()
+        self._vdi_ref = None
         VDI.VDI.__init__(self, sr, uuid)
         # Set VDI type - RBD provides raw block devices
         self.vdi_type = vhdutil.VDI_TYPE_RAW  # 'aio'
         if (self.is_a_snapshot):
-            self.rbd_name = "%s%s%s" % (sr.prefix, sr.SNAPSHOT_PREFIX, uuid)
+            self.rbd_name = sr._snap_prefix + uuid
             self.device_path = None
         else:
-            self.rbd_name = "%s%s%s" % (sr.prefix, sr.RBD_PREFIX, uuid)
-            self.device_path = "/dev/rbd/%s/%s" % (sr.pool, self.rbd_name)
+            self.rbd_name = sr._image_prefix + uuid
+            self.device_path = sr._dev_root + self.rbd_name
 
         if not hasattr(self, 'sm_config'):
             self.sm_config = {}
     
+    def _get_vdi_ref(self):
+        """Return this VDI's XAPI ref, resolving it at most once.
+
+        attach and detach both need the ref; caching it saves an XML-RPC
+        round-trip whenever more than one caller asks within an operation."""
+        if self._vdi_ref is None:
+            self._vdi_ref = self.sr.session.xenapi.VDI.get_by_uuid(self.uuid)
+        return self._vdi_ref
+
     def _load_if_exists(self, vdi_uuid):
         """Load VDI properties from XAPI database only if VDI exists in XAPI"""
         try:
             # Check if VDI exists in XAPI database
             vdi_ref = self.sr.session.xenapi.VDI.get_by_uuid(vdi_uuid)
+            self._vdi_ref = vdi_ref
             
             # VDI exists, load its properties
             util.SMlog("Loading existing VDI properties from XAPI database for %s" % vdi_uuid)
@@ -539,24 +969,25 @@ class CephRBDVDI(VDI.VDI):
             # Call parent load method first  
             VDI.VDI.load(self, vdi_uuid)
             
-            # Load key properties from XAPI database
-            self.is_a_snapshot = self.sr.session.xenapi.VDI.get_is_a_snapshot(vdi_ref)
-            self.read_only = self.sr.session.xenapi.VDI.get_read_only(vdi_ref)
-            self.size = int(self.sr.session.xenapi.VDI.get_virtual_size(vdi_ref))
-            self.utilisation = int(self.sr.session.xenapi.VDI.get_physical_utilisation(vdi_ref))
-            
-            # Load sm_config to get RBD-specific information
-            self.sm_config = self.sr.session.xenapi.VDI.get_sm_config(vdi_ref)
+            # Load key properties from XAPI database - one get_record instead
+            # of a separate RPC per field; scan runs this for every VDI
+            rec = self.sr.session.xenapi.VDI.get_record(vdi_ref)
+            self.is_a_snapshot = rec['is_a_snapshot']
+            self.read_only = rec['read_only']
+            self.size = int(rec['virtual_size'])
+            self.utilisation = int(rec['physical_utilisation'])
+
+            # sm_config carries the RBD-specific information
+            self.sm_config = rec['sm_config']
             
             # Restore the device path if it was stored during attach (using host-specific key)
-            host_ref = self.sr.session.xenapi.host.get_by_uuid(util.get_this_host())
-            host_key = "host_%s_device_path" % host_ref
+            host_key = self.sr._get_host_key()
             if host_key in self.sm_config:
                 self.attached = True
                 self.mapped = True
                 self.mapped_path_known = True
                 self.mapped_path = self.sm_config[host_key]
-                util.SMlog("Restored mapped path from sm_config for host %s: %s" % (host_ref, self.mapped_path))
+                util.SMlog("Restored mapped path from sm_config key %s: %s" % (host_key, self.mapped_path))
             else:
                 util.SMlog("Key not found: %s" % host_key)
             
@@ -600,15 +1031,22 @@ class CephRBDVDI(VDI.VDI):
         try:
             # Create RBD image with specified size and XCP-ng compatible features
             # Disable modern features that aren't supported by XCP-ng/Nautilus kernels
-            cmd = self.sr._build_rbd_cmd([
-                'create', 
-                '--size', str(size // (1024 * 1024)),  # RBD uses MB
-                '--image-format', '2',  # Use format 2 for advanced features
-                '--image-feature', 'layering',  # Only enable basic layering feature
-                self.rbd_name
-            ])
-            
-            util.pread2(cmd)
+            if self.sr.rbd is not None:
+                # Format 2, layering only - same layout the CLI fallback
+                # requests, created over the persistent connection
+                self.sr.rbd.create(self.sr.ioctx, self.rbd_name, size,
+                                   old_format=False,
+                                   features=librbd.RBD_FEATURE_LAYERING)
+            else:
+                cmd = self.sr._build_rbd_cmd([
+                    'create',
+                    '--size', str(size // MB),  # RBD uses MB
+                    '--image-format', '2',  # Use format 2 for advanced features
+                    '--image-feature', 'layering',  # Only enable basic layering feature
+                    self.rbd_name
+                ])
+
+                util.pread2(cmd)
             util.SMlog("Created RBD image: %s" % self.rbd_name)
             
             # Introduce VDI to XAPI database
@@ -626,7 +1064,7 @@ class CephRBDVDI(VDI.VDI):
             try:
                 cmd = self.sr._build_rbd_cmd(['rm', self.rbd_name])
                 util.pread2(cmd)
-            except:
+            except Exception:
                 pass
             raise xs_errors.XenError('VDICreate', opterr='Failed to create RBD image: %s' % str(e))
     
@@ -638,27 +1076,49 @@ class CephRBDVDI(VDI.VDI):
 
     def _try_find_parent(self):
         try:
-            # Check if parent image exists in the pool
-            cmd = self.sr._build_rbd_cmd(['ls', '-l', '--format', 'json'])
-            output = util.pread2(cmd)
-            if (output.strip()):
-                data = json.loads(output)
-                for image_info in data:
-                    if image_info['snapshot'] == self.rbd_name:
-                        return image_info['image']
-            
+            # Reuse the SR's batched pool listing (librbd over the persistent
+            # connection when available) instead of forking a private rbd ls
+            for image_info in self.sr._list_rbd_images():
+                if image_info.get('snapshot') == self.rbd_name:
+                    return image_info['image']
+
         except Exception as e:
             util.SMlog("Parent image for snapshot %s not found: %s" % (self.rbd_name, str(e)))
-            return None
+        return None
+
+    def _find_mapped_device(self):
+        """Find the local kernel device for this image via sysfs.
+
+        The kernel lists every mapped RBD under /sys/bus/rbd/devices, so a
+        readdir plus a few tiny file reads answers "is this image mapped on
+        this host" without forking the rbd CLI; the walk itself is shared
+        and TTL-cached at the SR level. Returns the device path or None
+        when the image isn't mapped locally (or sysfs is unavailable,
+        e.g. rbd-nbd setups)."""
+        # Snapshot mappings carry the snapshot name in a separate sysfs file
+        image_name, sep, snap_name = self.rbd_name.partition('@')
+        return self.sr._get_mapped_devices().get((image_name, snap_name))
 
     def delete(self, sr_uuid, vdi_uuid, data_only=False):
         """Delete RBD image"""
         util.SMlog("Deleting CephRBD VDI %s (data_only=%s)" % (vdi_uuid, data_only))
         util.SMlog("Is a snapshot: %s" % self.is_a_snapshot)
-        
+
         # Check if VDI is in use - follow SM framework convention
         if hasattr(self, 'attached') and self.attached:
             raise xs_errors.XenError('VDIInUse', opterr='VDI is currently attached')
+
+        # Cheap local-mapping check via sysfs - deleting a mapped image would
+        # fail cluster-side with "still has watchers" anyway, so catch the
+        # common local case early without any subprocess. The udev symlink
+        # is a single stat, so on a clean delete (not mapped, no symlink)
+        # we skip the sysfs scan entirely and only pay for it in the
+        # crash-recovery case
+        canonical = "/dev/rbd/%s/%s" % (self.sr.pool, self.rbd_name)
+        if self.mapped or os.path.exists(canonical):
+            mapped_device = self._find_mapped_device()
+            if mapped_device:
+                raise xs_errors.XenError('VDIInUse', opterr='VDI is still mapped locally as %s' % mapped_device)
         
         # If this is a snapshot, check if it's protected
         if (self.is_a_snapshot):
@@ -666,19 +1126,26 @@ class CephRBDVDI(VDI.VDI):
                 raise xs_errors.XenError('VDIInUse', opterr='VDI is a protected snapshot, cannot delete')
         else:
             # Check for snapshots (RBD doesn't allow deletion of images with snapshots)
+            snapshot_count = 0
             try:
-                # Get a JSON list of snapshots for this image
-                cmd = self.sr._build_rbd_cmd(['snap', 'ls', self.rbd_name, '--format', 'json'])
-                output = util.pread2(cmd)
-
-                if output.strip():
-                    snapshot_data = json.loads(output)
-                    snapshot_count = len(snapshot_data)
-                
-                    if snapshot_count > 0:
-                        raise xs_errors.XenError('VDIInUse', opterr='VDI has %d snapshots, cannot delete' % snapshot_count)
+                if self.sr.ioctx is not None:
+                    # In-process check over the persistent connection
+                    img = librbd.Image(self.sr.ioctx, self.rbd_name, read_only=True)
+                    try:
+                        snapshot_count = len(list(img.list_snaps()))
+                    finally:
+                        img.close()
+                else:
+                    # Get a JSON list of snapshots for this image
+                    cmd = self.sr._build_rbd_cmd(['snap', 'ls', self.rbd_name, '--format', 'json'])
+                    snaps = _json_pread(cmd)
+                    if snaps:
+                        snapshot_count = len(snaps)
             except Exception as e:
                 util.SMlog("Warning: Failed to check for snapshots: %s" % str(e))
+
+            if snapshot_count > 0:
+                raise xs_errors.XenError('VDIInUse', opterr='VDI has %d snapshots, cannot delete' % snapshot_count)
         
         try:
             if self.is_a_snapshot:
@@ -693,33 +1160,55 @@ class CephRBDVDI(VDI.VDI):
                     else:
                         util.SMlog("Fixed missing snapshot_of for snapshot %s: set to %s" % (self.rbd_name, self.snapshot_of))
 
-                try:
-                    # First try to unprotect the snapshot
-                    cmd = self.sr._build_rbd_cmd(['snap', 'unprotect', '--image', self._parent_name(), '--snap', self.rbd_name])
+                if self.sr.ioctx is not None:
+                    # Unprotect and remove on a single opened parent image
+                    # over the persistent connection
+                    img = librbd.Image(self.sr.ioctx, self._parent_name())
+                    try:
+                        try:
+                            img.unprotect_snap(self.rbd_name)
+                            util.SMlog("Unprotected snapshot: %s" % self.rbd_name)
+                        except Exception as e:
+                            # If unprotect fails, the snapshot might not be protected or might have children
+                            util.SMlog("Error: Failed to unprotect snapshot %s: %s" % (self.rbd_name, str(e)))
+                            raise xs_errors.XenError('VDIDelete', opterr='Failed to unprotect snapshot: %s' % str(e))
+                        img.remove_snap(self.rbd_name)
+                    finally:
+                        img.close()
+                else:
+                    try:
+                        # First try to unprotect the snapshot
+                        cmd = self.sr._build_rbd_cmd(['snap', 'unprotect', '--image', self._parent_name(), '--snap', self.rbd_name])
+                        util.pread2(cmd)
+                        util.SMlog("Unprotected snapshot: %s" % self.rbd_name)
+                    except Exception as e:
+                        # If unprotect fails, the snapshot might not be protected or might have children
+                        util.SMlog("Error: Failed to unprotect snapshot %s: %s" % (self.rbd_name, str(e)))
+                        raise xs_errors.XenError('VDIDelete', opterr='Failed to unprotect snapshot: %s' % str(e))
+
+                    # Delete the snapshot
+                    cmd = self.sr._build_rbd_cmd(['snap', 'rm', '--image', self._parent_name(), '--snap', self.rbd_name])
                     util.pread2(cmd)
-                    util.SMlog("Unprotected snapshot: %s" % self.rbd_name)
-                except Exception as e:
-                    # If unprotect fails, the snapshot might not be protected or might have children
-                    util.SMlog("Error: Failed to unprotect snapshot %s: %s" % (self.rbd_name, str(e)))
-                    raise xs_errors.XenError('VDIDelete', opterr='Failed to unprotect snapshot: %s' % str(e))
-                
-                # Delete the snapshot
-                cmd = self.sr._build_rbd_cmd(['snap', 'rm', '--image', self._parent_name(), '--snap', self.rbd_name])
-                util.pread2(cmd)
                 util.SMlog("Deleted RBD snapshot: %s" % self.rbd_name)
                 
             else:
                 # This is a regular RBD image
                 util.SMlog("Deleting RBD image: %s" % self.rbd_name)
                 
-                try:
-                    # Delete the RBD image
-                    cmd = self.sr._build_rbd_cmd(['rm', self.rbd_name])
-                    util.pread2(cmd)
+                if self.sr.rbd is not None:
+                    # In-process removal; ImageBusy/ImageNotFound propagate
+                    # to the handler below which classifies them
+                    self.sr.rbd.remove(self.sr.ioctx, self.rbd_name)
                     util.SMlog("Deleted RBD image: %s" % self.rbd_name)
-                except Exception as e:
-                    util.SMlog("Error: Failed to delete RBD image %s: %s" % (self.rbd_name, str(e)))
-                    raise xs_errors.XenError('VDIDelete', opterr='Failed to delete RBD image: %s' % str(e))
+                else:
+                    try:
+                        # Delete the RBD image
+                        cmd = self.sr._build_rbd_cmd(['rm', self.rbd_name])
+                        util.pread2(cmd)
+                        util.SMlog("Deleted RBD image: %s" % self.rbd_name)
+                    except Exception as e:
+                        util.SMlog("Error: Failed to delete RBD image %s: %s" % (self.rbd_name, str(e)))
+                        raise xs_errors.XenError('VDIDelete', opterr='Failed to delete RBD image: %s' % str(e))
             
             # Update SR allocation and statistics
             if self.uuid in self.sr.vdis:
@@ -731,12 +1220,20 @@ class CephRBDVDI(VDI.VDI):
                 self.sr._updateStats(sr_uuid, -size_to_subtract)
                 
         except Exception as e:
-            # Handle different types of deletion errors
+            # Handle different types of deletion errors - librbd raises
+            # typed exceptions, the CLI surfaces them as message text
             error_str = str(e)
-            
-            if 'watchers' in error_str or 'still has watchers' in error_str:
+            in_use = 'watchers' in error_str
+            missing = 'No such file or directory' in error_str
+            if librbd is not None:
+                if isinstance(e, librbd.ImageBusy):
+                    in_use = True
+                elif isinstance(e, librbd.ImageNotFound):
+                    missing = True
+
+            if in_use:
                 raise xs_errors.XenError('VDIInUse', opterr='VDI is still mapped on one or more hosts. Please ensure all VMs using this VDI are shut down and try again.')
-            elif 'No such file or directory' in error_str:
+            elif missing:
                 # RBD image/snapshot doesn't exist - this might be an orphaned XAPI VDI entry
                 util.SMlog("RBD image/snapshot %s does not exist - might be orphaned XAPI entry, cleaning up VDI record" % self.rbd_name)
                 # Still remove from SR vdis list to clean up
@@ -752,13 +1249,22 @@ class CephRBDVDI(VDI.VDI):
         util.SMlog("Attaching CephRBD VDI %s" % self.uuid)
 
         try:
-            # Map RBD image or snapshot to kernel device
-            # For snapshots, rbd_name will be in format "image@snap-name"
-            # For regular images, rbd_name will be just "image-name"
-            cmd = self.sr._build_rbd_cmd(['map', self.rbd_name])
-            
-            device = util.pread2(cmd).strip()
-            
+            # If the image is already mapped (re-attach after a crash, or a
+            # previous attach on this host), the udev symlink is already in
+            # place - a single stat saves the whole rbd map subprocess
+            canonical = "/dev/rbd/%s/%s" % (self.sr.pool, self.rbd_name)
+            if os.path.exists(canonical):
+                device = os.path.realpath(canonical)
+                util.SMlog("RBD image %s already mapped to %s, skipping map" % (self.rbd_name, device))
+            else:
+                # Map RBD image or snapshot to kernel device
+                # For snapshots, rbd_name will be in format "image@snap-name"
+                # For regular images, rbd_name will be just "image-name"
+                cmd = self.sr._build_rbd_cmd(['map', self.rbd_name])
+
+                device = util.pread2(cmd).strip()
+                self.sr._invalidate_mapped_cache()
+
             # Verify device was created and is accessible
             if not os.path.exists(device):
                 raise Exception("Mapped device not found: %s" % device)
@@ -778,14 +1284,17 @@ class CephRBDVDI(VDI.VDI):
 
         # Store the device path in VDI sm_config with host-specific key for migration resilience
         # Use host-specific key to support multiple simultaneous attachments during migration
-        host_ref = self.sr.session.xenapi.host.get_by_uuid(util.get_this_host())
-        host_key = "host_%s_device_path" % host_ref
-        
-        # Use direct XAPI call to add host-specific key (bypasses _db_update filtering)
-        vdi_ref = self.sr.session.xenapi.VDI.get_by_uuid(self.uuid)
-        self.sr.session.xenapi.VDI.add_to_sm_config(vdi_ref, host_key, self.device_path)
-        
-        util.SMlog("Stored device path %s for host %s in sm_config key %s" % (self.device_path, host_ref, host_key))
+        host_key = self.sr._get_host_key()
+
+        # On a reattach the key is typically already present with the same
+        # value (restored by _load_if_exists) - skip the XAPI write then,
+        # it would be rejected as a duplicate anyway
+        if self.sm_config.get(host_key) == self.device_path:
+            util.SMlog("Device path %s already stored in sm_config key %s" % (self.device_path, host_key))
+        else:
+            # Use direct XAPI call to add host-specific key (bypasses _db_update filtering)
+            self.sr.session.xenapi.VDI.add_to_sm_config(self._get_vdi_ref(), host_key, self.device_path)
+            util.SMlog("Stored device path %s for this host in sm_config key %s" % (self.device_path, host_key))
         
         # Call base class attach which returns the proper XMLRPC struct
         return VDI.VDI.attach(self, sr_uuid, vdi_uuid)
@@ -803,30 +1312,42 @@ class CephRBDVDI(VDI.VDI):
         self.device_path = self.mapped_path
 
         try:
-            cmd = self.sr._build_rbd_cmd(['unmap', self.device_path])
-            util.pread2(cmd)
-            
-            self.mapped = False
-            self.attached = False
-            
+            self._unmap_device()
+
             # Clean up the host-specific device path from sm_config
-            host_ref = self.sr.session.xenapi.host.get_by_uuid(util.get_this_host())
-            host_key = "host_%s_device_path" % host_ref
-            
-            # Use direct XAPI call to remove host-specific key
-            vdi_ref = self.sr.session.xenapi.VDI.get_by_uuid(self.uuid)
-            current_sm_config = self.sr.session.xenapi.VDI.get_sm_config(vdi_ref)
-            if host_key in current_sm_config:
-                self.sr.session.xenapi.VDI.remove_from_sm_config(vdi_ref, host_key)
-                util.SMlog("Cleaned up device path for host %s from sm_config" % host_ref)
-            else:
-                util.SMlog("Device path key %s not found in sm_config, nothing to clean up" % host_key)
+            self._clean_sm_config_device_path()
             
             util.SMlog("Unmapped RBD image %s from device %s" % (self.rbd_name, self.device_path))
             
         except Exception as e:
             # Log warning but don't fail - device may have been unmapped already
             util.SMlog("Warning: Failed to unmap RBD device %s: %s" % (self.device_path, str(e)))
+
+    def _unmap_device(self):
+        """Unmap the kernel device for this VDI.
+
+        Deliberately free of XAPI traffic so SR detach can overlap these
+        across worker threads - the shared session's transport must never
+        see concurrent requests."""
+        cmd = self.sr._build_rbd_cmd(['unmap', self.device_path])
+        util.pread2(cmd)
+        self.sr._invalidate_mapped_cache()
+
+        self.mapped = False
+        self.attached = False
+
+    def _clean_sm_config_device_path(self):
+        """Remove this host's device-path key from sm_config"""
+        host_key = self.sr._get_host_key()
+
+        # Use direct XAPI call to remove host-specific key. Removal of an
+        # absent key is harmless, so don't spend a get_sm_config
+        # round-trip pre-checking for it
+        try:
+            self.sr.session.xenapi.VDI.remove_from_sm_config(self._get_vdi_ref(), host_key)
+            util.SMlog("Cleaned up device path key %s from sm_config" % host_key)
+        except Exception as e:
+            util.SMlog("Device path key %s not removed from sm_config (%s), nothing to clean up" % (host_key, str(e)))
     
     def snapshot(self, sr_uuid, vdi_uuid):
         """Create VDI snapshot"""
@@ -838,20 +1359,26 @@ class CephRBDVDI(VDI.VDI):
             raise xs_errors.XenError('VDISnapshot', opterr='Cannot snapshot a snapshot')
         
         # Generate new UUID for the snapshot
-        snapshot_uuid = util.gen_uuid()
+        snapshot_uuid = str(uuid.uuid4())
         util.SMlog("Generated new UUID for snapshot: %s" % snapshot_uuid)
 
         snapshot_name = "%s%s%s" % (self.sr.prefix, self.sr.SNAPSHOT_PREFIX, snapshot_uuid)
-        
+        # Build the image@snapshot spec once - it is reused by the CLI
+        # commands, the snapshot VDI and the failure cleanup below
+        snap_spec = "%s@%s" % (self.rbd_name, snapshot_name)
+
+        snap_created = False
         try:
-            # Create snapshot of current RBD image
-            cmd = self.sr._build_rbd_cmd(['snap', 'create', '%s@%s' % (self.rbd_name, snapshot_name)])
-            util.pread2(cmd)
-            
-            # Protect snapshot (makes it read-only and prevents deletion)
-            cmd = self.sr._build_rbd_cmd(['snap', 'protect', '%s@%s' % (self.rbd_name, snapshot_name)])
-            util.pread2(cmd)
-            
+            # Serialize against other snapshot/clone operations on this SR -
+            # racing protects on the same parent fail transiently and would
+            # force a full rollback plus retry
+            self.sr.lock.acquire()
+            try:
+                self._snap_create_and_protect(snapshot_name)
+            finally:
+                self.sr.lock.release()
+            snap_created = True
+
             # Create snapshot VDI object with the new UUID - this represents the read-only snapshot
             snapshot_vdi = self.sr.vdi(snapshot_uuid)
             snapshot_vdi.size = self.size
@@ -859,7 +1386,7 @@ class CephRBDVDI(VDI.VDI):
             snapshot_vdi.utilisation = 0  # Snapshot is thin-provisioned
             snapshot_vdi.parent = self
             # Store the snapshot reference instead of RBD image name
-            snapshot_vdi.rbd_name = "%s@%s" % (self.rbd_name, snapshot_name)
+            snapshot_vdi.rbd_name = snap_spec
             
             # Set additional VDI properties for proper database introduction
             snapshot_vdi.location = snapshot_uuid
@@ -895,20 +1422,83 @@ class CephRBDVDI(VDI.VDI):
             return snapshot_vdi.get_params()
             
         except Exception as e:
-            # Cleanup on failure
-            try:
-                # Unprotect and remove snapshot if it was created
-                cmd = self.sr._build_rbd_cmd(['snap', 'unprotect', '%s@%s' % (self.rbd_name, snapshot_name)])
-                util.pread2(cmd)
-                cmd = self.sr._build_rbd_cmd(['snap', 'rm', '%s@%s' % (self.rbd_name, snapshot_name)])
-                util.pread2(cmd)
-            except:
-                pass
+            # Only roll back state we actually created - a failed
+            # create/protect cleans up after itself, so the unprotect+rm
+            # pair is reserved for failures past that point
+            if snap_created:
+                self._cleanup_snap(self.rbd_name, snapshot_name)
             raise xs_errors.XenError('VDISnapshot', opterr='Failed to create RBD snapshot: %s' % str(e))
 
+    def _snap_create_and_protect(self, snapshot_name):
+        """Create and protect a snapshot of this image.
+
+        With librbd both steps run on one opened image over the persistent
+        connection; the CLI fallback pays two invocations (cloning requires
+        the snapshot to be protected, so the pair always travels together)."""
+        if self.sr.ioctx is not None:
+            img = librbd.Image(self.sr.ioctx, self.rbd_name)
+            try:
+                img.create_snap(snapshot_name)
+                try:
+                    img.protect_snap(snapshot_name)
+                except Exception:
+                    # Undo just the create - the snapshot is still
+                    # unprotected, so a plain remove is all that's needed
+                    try:
+                        img.remove_snap(snapshot_name)
+                    except Exception:
+                        pass
+                    raise
+            finally:
+                img.close()
+        else:
+            snap_spec = "%s@%s" % (self.rbd_name, snapshot_name)
+            util.pread2(self.sr._build_rbd_cmd(['snap', 'create', snap_spec]))
+            try:
+                util.pread2(self.sr._build_rbd_cmd(['snap', 'protect', snap_spec]))
+            except Exception:
+                try:
+                    util.pread2(self.sr._build_rbd_cmd(['snap', 'rm', snap_spec]))
+                except Exception:
+                    pass
+                raise
+
+    def _cleanup_snap(self, image_name, snapshot_name):
+        """Best-effort unprotect + remove of a snapshot for failure cleanup.
+
+        One opened image serves both steps on the librbd path; unprotect
+        failures are swallowed on their own (the snapshot may never have
+        been protected) so the removal always gets its chance. Never
+        raises - this runs inside exception handlers."""
+        try:
+            if self.sr.ioctx is not None:
+                img = librbd.Image(self.sr.ioctx, image_name)
+                try:
+                    try:
+                        img.unprotect_snap(snapshot_name)
+                    except Exception:
+                        pass
+                    img.remove_snap(snapshot_name)
+                finally:
+                    img.close()
+            else:
+                snap_spec = "%s@%s" % (image_name, snapshot_name)
+                try:
+                    util.pread2(self.sr._build_rbd_cmd(['snap', 'unprotect', snap_spec]))
+                except Exception:
+                    pass
+                util.pread2(self.sr._build_rbd_cmd(['snap', 'rm', snap_spec]))
+        except Exception as e:
+            util.SMlog("Warning: Failed to clean up snapshot %s@%s: %s" % (image_name, snapshot_name, str(e)))
+
     def _clone_rbd(self, image_name, snapshot_name, target_name):
         """Helper function to clone RBD image from snapshot"""
         try:
+            if self.sr.rbd is not None:
+                self.sr.rbd.clone(self.sr.ioctx, image_name, snapshot_name,
+                                  self.sr.ioctx, target_name,
+                                  features=librbd.RBD_FEATURE_LAYERING)
+                return True
             cmd = self.sr._build_rbd_cmd([
                 'clone', 
                 '--image',
@@ -928,7 +1518,7 @@ class CephRBDVDI(VDI.VDI):
         util.SMlog("Creating CephRBD clone from VDI %s" % self.uuid)
         
         # Generate new UUID for the clone
-        clone_uuid = util.gen_uuid()
+        clone_uuid = str(uuid.uuid4())
         clone_name = "%s%s%s" % (self.sr.prefix, self.sr.RBD_PREFIX, clone_uuid)
         source_image = None
         snapshot_name = None
@@ -938,34 +1528,34 @@ class CephRBDVDI(VDI.VDI):
             source_image = self._parent_name()
             snapshot_name = self.rbd_name
         else:
-            # This is a regular image - create a temporary snapshot and clone from it   
-            snapshot_uuid = util.gen_uuid()
+            # This is a regular image - create a temporary snapshot and clone from it
+            snapshot_uuid = str(uuid.uuid4())
             util.SMlog("Requested clone of pure RBD image, creating temporary snap. Generated new UUID for cloned VDI: %s using temp clone with UUID: %s" % (clone_uuid, snapshot_uuid))
             snapshot_name = "%s%sclone-temp-%s" % (self.sr.prefix, self.sr.SNAPSHOT_PREFIX, snapshot_uuid)
-        
-            try:
-                # Create snapshot of current RBD image
-                cmd = self.sr._build_rbd_cmd(['snap', 'create', '%s@%s' % (self.rbd_name, snapshot_name)])
-                util.pread2(cmd)
-                
-                # Protect snapshot (required for cloning)
-                cmd = self.sr._build_rbd_cmd(['snap', 'protect', '%s@%s' % (self.rbd_name, snapshot_name)])
-                util.pread2(cmd)
-                
-                # Create clone from snapshot (this creates a new writable RBD image)
-                cmd = self.sr._build_rbd_cmd([
-                    'clone', 
-                    '%s@%s' % (self.rbd_name, snapshot_name),
-                    clone_name
-                ])
-                util.pread2(cmd)
-                
-            except Exception as e:
-                raise xs_errors.XenError('VDIClone', opterr='Failed to create RBD clone: %s' % str(e))
-            
+            source_image = self.rbd_name
 
-        if not self._clone_rbd(source_image, snapshot_name, clone_name):
-            raise xs_errors.XenError('VDIClone', opterr='Failed to create RBD clone from snapshot')
+        # Serialize the create->protect->clone sequence against other
+        # snapshot/clone operations on this SR (same rationale as snapshot())
+        self.sr.lock.acquire()
+        try:
+            if not self.is_a_snapshot:
+                try:
+                    # Temporary snapshot to clone from (must be protected)
+                    self._snap_create_and_protect(snapshot_name)
+
+                except Exception as e:
+                    raise xs_errors.XenError('VDIClone', opterr='Failed to create RBD clone: %s' % str(e))
+
+            try:
+                if not self._clone_rbd(source_image, snapshot_name, clone_name):
+                    raise xs_errors.XenError('VDIClone', opterr='Failed to create RBD clone from snapshot')
+            except Exception:
+                if not self.is_a_snapshot:
+                    # Don't leak the temporary snapshot taken above
+                    self._cleanup_snap(self.rbd_name, snapshot_name)
+                raise
+        finally:
+            self.sr.lock.release()
             
         # Create clone VDI object with the new UUID
         clone_vdi = self.sr.vdi(clone_uuid)
@@ -1011,36 +1601,54 @@ class CephRBDVDI(VDI.VDI):
         """Resize RBD image"""
         util.SMlog("Resizing CephRBD VDI %s from %d to %d (online=%s)" % (vdi_uuid, self.size, size, online))
         
-        if size == self.size:
+        # rbd takes the size in MB - round up so a request that isn't
+        # MB-aligned never silently shrinks the image below what the
+        # caller asked for, and track the rounded byte count so our
+        # accounting matches what's actually on disk
+        size_mb = (size + MB - 1) // MB
+
+        # No-op when the rounded request already matches the image: catches
+        # both byte-equal requests and ones that only differ within rbd's
+        # MB granularity, saving the whole rbd fork + cluster round-trip
+        if size == self.size or size_mb * MB == self.size:
             return VDI.VDI.get_params(self)
-        
+
         try:
-            cmd = None
-            if size < self.size:
-                 cmd = self.sr._build_rbd_cmd([
-                    'resize',
-                    '--allow-shrink',
-                    '--size', str(size // (1024 * 1024)),  # RBD uses MB
-                    self.rbd_name
-                ])
+            if self.sr.ioctx is not None:
+                # In-process resize over the persistent connection; librbd
+                # has no separate shrink guard, the CLI flag only exists to
+                # protect interactive use
+                img = librbd.Image(self.sr.ioctx, self.rbd_name)
+                try:
+                    img.resize(size_mb * MB)
+                finally:
+                    img.close()
             else:
-                # Resize RBD image
-                cmd = self.sr._build_rbd_cmd([
-                    'resize',
-                    '--size', str(size // (1024 * 1024)),  # RBD uses MB
-                    self.rbd_name
-                ])
-            
-            util.pread2(cmd)
-            
+                if size < self.size:
+                    cmd = self.sr._build_rbd_cmd([
+                        'resize',
+                        '--allow-shrink',
+                        '--size', str(size_mb),
+                        self.rbd_name
+                    ])
+                else:
+                    # Resize RBD image
+                    cmd = self.sr._build_rbd_cmd([
+                        'resize',
+                        '--size', str(size_mb),
+                        self.rbd_name
+                    ])
+
+                util.pread2(cmd)
+
             # Update size tracking
             old_size = self.size
-            self.size = size
-            size_delta = size - old_size
+            self.size = size_mb * MB
+            size_delta = self.size - old_size
             self.sr._updateStats(sr_uuid, size_delta)
             self._db_update()
-            
-            util.SMlog("Resized RBD image %s to %d bytes" % (self.rbd_name, size))
+
+            util.SMlog("Resized RBD image %s to %d bytes (%d MB, requested %d)" % (self.rbd_name, self.size, size_mb, size))
             
         except Exception as e:
             raise xs_errors.XenError('VDISize', opterr='Failed to resize RBD image: %s' % str(e))
@@ -1114,8 +1722,11 @@ class CephRBDVDI(VDI.VDI):
             self.read_only = True
             self.parent_uuid = rbd_info['image']
 
-# Register the driver with the SR framework
+# Register the driver with the SR framework. Registration is guarded so a
+# long-lived host importing this module from several workers doesn't
+# re-register the driver on every import
 if __name__ == '__main__':
     SRCommand.run(CephRBDSR, DRIVER_INFO)
-else:
+elif not getattr(SR, '_cephrbd_registered', False):
     SR.registerSR(CephRBDSR)
+    SR._cephrbd_registered = True
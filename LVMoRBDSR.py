@@ -29,6 +29,99 @@ import re
 import lvutil
 import scsiutil
 
+# Optional streaming JSON parser - lets the showmapped lookup stop
+# parsing as soon as our image's record is found
+try:
+    import ijson
+    import io
+except ImportError:
+    ijson = None
+
+# Native Ceph bindings - when available, image create/delete run over one
+# authenticated cluster connection instead of paying fork/exec plus a
+# CephX handshake per rbd CLI invocation. Kernel map/unmap still needs
+# the CLI and the CLI remains the fallback throughout.
+try:
+    import rados
+    import rbd as librbd
+except ImportError:
+    rados = None
+    librbd = None
+
+# Optional udev bindings - lets _wait_for_block_device block on a kernel
+# event instead of polling for the device node to appear
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
+
+# Compiled once at import - _parse_size_with_units runs in the SR create
+# path and should not pay re's cache lookup on every call
+_SIZE_RE = re.compile(r'^(\d+(?:\.\d+)?)\s*([KMGT]?)B?$')
+
+# Unit multipliers to MB for _parse_size_with_units - dict lookup instead
+# of an if/elif chain over the unit suffix
+_UNIT_MB = {'': 1, 'K': 1.0 / 1024, 'M': 1, 'G': 1024, 'T': 1024 * 1024}
+
+# How long a showmapped result stays valid. Mappings only change through
+# our own map/unmap calls (which refresh the cache), so a short window is
+# safe and spares repeated rbd forks within one SR operation
+DEVICE_CACHE_TTL = 2.0
+
+# Accepted spellings for boolean device-config flags
+_TRUTHY = frozenset(['1', 'true', 'yes', 'on'])
+
+# Marks "variable was not set at all" when saving LVM_SYSTEM_DIR, so an
+# empty-string value can be restored faithfully
+_UNSET = object()
+
+def _wait_for_block_device(path, timeout):
+    """Wait for a block device node to appear.
+
+    With pyudev available this blocks on a netlink monitor and wakes on
+    the actual uevent, typically within milliseconds of the kernel
+    creating the node; without it (or if the monitor fails) it falls back
+    to util.wait_for_path's polling loop."""
+    if os.path.exists(path):
+        return True
+
+    if pyudev is None:
+        return util.wait_for_path(path, timeout)
+
+    try:
+        context = pyudev.Context()
+        monitor = pyudev.Monitor.from_netlink(context)
+        monitor.filter_by('block')
+        monitor.start()
+
+        # The node may have appeared between the check above and the
+        # monitor starting - look again now that events are flowing
+        if os.path.exists(path):
+            return True
+
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return os.path.exists(path)
+            device = monitor.poll(timeout=remaining)
+            if device is None:
+                # Monitor timed out - one last direct check
+                return os.path.exists(path)
+            if device.device_node == path or os.path.exists(path):
+                return True
+    except Exception as e:
+        util.SMlog("udev wait for %s failed (%s), falling back to polling" % (path, str(e)))
+        return util.wait_for_path(path, timeout)
+
+def _read_sysfs(path):
+    """Read and strip a small sysfs attribute file"""
+    f = open(path)
+    try:
+        return f.read().strip()
+    finally:
+        f.close()
+
 CAPABILITIES = ["SR_PROBE", "SR_UPDATE", "SR_METADATA", "SR_TRIM",
                 "VDI_CREATE", "VDI_DELETE", "VDI_ATTACH", "VDI_DETACH",
                 "VDI_GENERATE_CONFIG", "VDI_CLONE", "VDI_SNAPSHOT",
@@ -75,27 +168,40 @@ class LVMoRBDSR(LVHDSR.LVHDSR):
 
     # For that reason we implement our own LVM config files in /etc/lvm/lvmorbd and use
     # these instead - they are configured to match only RBD devices and no other.
+    # Whether LVMoRBD_CONF_DIR exists - the setup script installs it once,
+    # so a single stat per process is enough (None = not checked yet)
+    _conf_dir_exists = None
+
     def _with_rbd_lvm_conf(self, func, *args, **kwargs):
         """Execute function with RBD-aware LVM configuration"""
-        # Save current LVM_SYSTEM_DIR
-        old_lvm_dir = os.environ.get('LVM_SYSTEM_DIR', '')
-        
-        try:
-            # Use the RBD-aware LVM configuration installed by the setup script
-            if os.path.exists(self.LVMoRBD_CONF_DIR):
-                util.SMlog("Using RBD-aware LVM configuration from %s" % self.LVMoRBD_CONF_DIR)
-                os.environ['LVM_SYSTEM_DIR'] = self.LVMoRBD_CONF_DIR
-            else:
+        # Use the RBD-aware LVM configuration installed by the setup script
+        if LVMoRBDSR._conf_dir_exists is None:
+            LVMoRBDSR._conf_dir_exists = os.path.exists(self.LVMoRBD_CONF_DIR)
+            if not LVMoRBDSR._conf_dir_exists:
                 util.SMlog("Warning: RBD LVM configuration not found at %s, using default" % self.LVMoRBD_CONF_DIR)
 
+        if not LVMoRBDSR._conf_dir_exists:
+            return func(*args, **kwargs)
+
+        # Nested wrapped calls already run with the right environment -
+        # skip the save/swap/restore dance entirely
+        if os.environ.get('LVM_SYSTEM_DIR') == self.LVMoRBD_CONF_DIR:
+            return func(*args, **kwargs)
+
+        # Save current LVM_SYSTEM_DIR (sentinel distinguishes unset from
+        # empty, and the restore below is a single branch either way)
+        old_lvm_dir = os.environ.get('LVM_SYSTEM_DIR', _UNSET)
+
+        os.environ['LVM_SYSTEM_DIR'] = self.LVMoRBD_CONF_DIR
+        try:
             # Execute the function
             return func(*args, **kwargs)
         finally:
             # Restore original LVM_SYSTEM_DIR
-            if old_lvm_dir:
+            if old_lvm_dir is _UNSET:
+                os.environ.pop('LVM_SYSTEM_DIR', None)
+            else:
                 os.environ['LVM_SYSTEM_DIR'] = old_lvm_dir
-            elif 'LVM_SYSTEM_DIR' in os.environ:
-                del os.environ['LVM_SYSTEM_DIR']
 
     # Parent LVM SM class is sadly running scsi commands on every block device
     # RBD images don't support these calls, so we use this wrapper
@@ -119,8 +225,7 @@ class LVMoRBDSR(LVHDSR.LVHDSR):
         
         # For RBD devices, we use a synthetic serial record based on pool/image name
         # This helps with device tracking without relying on SCSI serial numbers
-        rbd_serial = "RBD:%s:%s" % (self.pool, self.rbd_image)
-        scsiutil.add_serial_record(self.session, self.sr_ref, rbd_serial)
+        scsiutil.add_serial_record(self.session, self.sr_ref, self.rbd_serial)
         
         # Enable VHD mode (required for LVHDSR functionality)
         self.session.xenapi.SR.add_to_sm_config(self.sr_ref, self.FLAG_USE_VHD, 'true')
@@ -150,24 +255,12 @@ class LVMoRBDSR(LVHDSR.LVHDSR):
         size_str = str(size_str).strip().upper()
         
         # Match number with optional unit
-        match = re.match(r'^(\d+(?:\.\d+)?)\s*([KMGT]?)B?$', size_str)
+        match = _SIZE_RE.match(size_str)
         if not match:
             raise ValueError("Invalid size format. Use formats like: 1024, 10G, 2T, 500M")
         
-        number = float(match.group(1))
-        unit = match.group(2)
-        
-        # Convert to MB
-        if unit == '' or unit == 'M':
-            return int(number)
-        elif unit == 'K':
-            return int(number / 1024)
-        elif unit == 'G':
-            return int(number * 1024)
-        elif unit == 'T':
-            return int(number * 1024 * 1024)
-        else:
-            raise ValueError("Unsupported unit: %s" % unit)
+        # Convert to MB via the unit multiplier table
+        return int(float(match.group(1)) * _UNIT_MB[match.group(2)])
 
     def load(self, sr_uuid):
         if not sr_uuid:
@@ -188,14 +281,42 @@ class LVMoRBDSR(LVHDSR.LVHDSR):
         self.ceph_user = self.dconf.get('user', 'admin')
         self.keyring = self.dconf.get('keyring', '')
         self.mon_host = self.dconf.get('mon_host', '')
-        self.protected = self.dconf.get('protected', 'true').lower() == 'true'
+        self.protected = str(self.dconf.get('protected', 'true')).strip().lower() in _TRUTHY
         
-        # Build full RBD name
+        # Build full RBD name and the synthetic serial used for device
+        # tracking - neither changes after load
         self.rbd_name = "%s/%s" % (self.pool, self.rbd_image)
+        self.rbd_serial = "RBD:%s:%s" % (self.pool, self.rbd_image)
+
+        # Authentication flags never change after load - build the rbd
+        # command prefix once instead of re-assembling it per invocation
+        prefix = ['rbd']
+        if self.ceph_conf:
+            prefix.extend(['-c', self.ceph_conf])
+        if self.ceph_user:
+            prefix.extend(['--id', self.ceph_user])
+        if self.keyring:
+            prefix.extend(['--keyring', self.keyring])
+        if self.mon_host:
+            prefix.extend(['-m', self.mon_host])
+        self._rbd_cmd_prefix = prefix
+
+        # Cluster connection via the native bindings - opened lazily by
+        # _connect_cluster, since only image create/delete ever use it and
+        # the hot attach/detach/scan paths shouldn't pay a MON handshake
+        self._cluster = None
+        self._ioctx = None
+        self._rbd = None
+        self._cluster_tried = False
         
         # Initialize device path (will be set when mapped)
         self.device_path = None
-        
+
+        # showmapped cache - load, scan and the map/unmap helpers all ask
+        # for the device path, often within the same second
+        self._device_path_cache = None
+        self._device_path_cache_time = 0
+
         # Check if RBD is already mapped and set device path
         mapped_device = self._get_rbd_device_path()
         if mapped_device:
@@ -206,57 +327,132 @@ class LVMoRBDSR(LVHDSR.LVHDSR):
         # Call parent load
         LVHDSR.LVHDSR.load(self, sr_uuid)
 
+    def _connect_cluster(self):
+        """Open the librados connection on first use.
+
+        Only _create_rbd_image/_delete_rbd_image consume the bindings, so
+        the connection is deferred until one of them runs - eager connects
+        in load() would cost every attach/detach/scan a MON round-trip
+        (and up to the connect timeout on a degraded cluster) for nothing.
+        Returns the RBD client, or None when the bindings are missing or
+        the connection failed; only one attempt is made per process."""
+        if self._rbd is not None or self._cluster_tried or rados is None:
+            return self._rbd
+
+        self._cluster_tried = True
+        try:
+            conf = {}
+            if self.keyring:
+                conf['keyring'] = self.keyring
+            if self.mon_host:
+                conf['mon_host'] = self.mon_host
+            self._cluster = rados.Rados(conffile=self.ceph_conf,
+                                        rados_id=self.ceph_user, conf=conf)
+            self._cluster.connect(timeout=30)
+            self._ioctx = self._cluster.open_ioctx(self.pool)
+            self._rbd = librbd.RBD()
+        except Exception as e:
+            util.SMlog("librados connection failed (%s), using rbd CLI" % str(e))
+            self._close_cluster()
+        return self._rbd
+
+    def _close_cluster(self):
+        """Tear down the librados connection (best effort)"""
+        try:
+            if self._ioctx is not None:
+                self._ioctx.close()
+            if self._cluster is not None:
+                self._cluster.shutdown()
+        except Exception:
+            pass
+        self._cluster = None
+        self._ioctx = None
+        self._rbd = None
+
     def _build_rbd_cmd(self, args):
         """Build RBD command with proper authentication"""
-        cmd = ['rbd']
-        
-        # Add configuration file
-        if self.ceph_conf:
-            cmd.extend(['-c', self.ceph_conf])
-            
-        # Add user authentication
-        if self.ceph_user:
-            cmd.extend(['--id', self.ceph_user])
-            
-        # Add keyring if specified
-        if self.keyring:
-            cmd.extend(['--keyring', self.keyring])
-            
-        # Add monitor hosts if specified
-        if self.mon_host:
-            cmd.extend(['-m', self.mon_host])
-            
-        # Add the actual command
-        cmd.extend(args)
-        
-        return cmd
+        return self._rbd_cmd_prefix + args
 
     def _get_rbd_device_path(self):
-        """Get the current device path for our RBD image"""
+        """Get the current device path for our RBD image.
+
+        The result (mapped or not) is cached for DEVICE_CACHE_TTL seconds;
+        _map_rbd_image/_unmap_rbd_image refresh the cache when they change
+        the mapping, so repeated callers within one operation don't each
+        pay an rbd showmapped fork."""
+        if time.time() - self._device_path_cache_time < DEVICE_CACHE_TTL:
+            return self._device_path_cache
+
+        device_path = None
         try:
             cmd = self._build_rbd_cmd(['showmapped', '--format', 'json'])
             output = util.pread2(cmd)
             
             if output.strip():
-                mapped = json.loads(output)
-                for info in mapped:
+                if ijson is not None:
+                    # Streaming parse terminates at our record instead of
+                    # materializing every mapping on the host first
+                    records = ijson.items(io.BytesIO(output), 'item')
+                else:
+                    records = json.loads(output)
+                for info in records:
                     if (info['pool'] == self.pool and 
                         info['name'] == self.rbd_image):
-                        return info['device']
+                        device_path = info['device']
+                        break
         except Exception as e:
             util.SMlog("Failed to get RBD device path: %s" % str(e))
-        
-        return None
+            # Don't cache a failed lookup
+            return None
+
+        self._cache_device_path(device_path)
+        return device_path
+
+    def _cache_device_path(self, device_path):
+        """Record the current mapping state in the showmapped cache"""
+        self._device_path_cache = device_path
+        self._device_path_cache_time = time.time()
+
+    def _invalidate_device_cache(self):
+        """Force the next _get_rbd_device_path to ask the rbd CLI again"""
+        self._device_path_cache_time = 0
     
     def _check_if_rbd_mapped(self):
-        """Check if the RBD image is currently mapped"""
-        device_path = self._get_rbd_device_path()
-        return device_path is not None
+        """Check if the RBD image is currently mapped.
+
+        Answered without a subprocess where possible: a known device path
+        is a single stat, and the kernel lists every mapping under
+        /sys/bus/rbd/devices so a readdir plus two tiny file reads covers
+        the rest. The rbd CLI is only consulted when sysfs is unavailable
+        (e.g. rbd-nbd setups)."""
+        if self.device_path and os.path.exists(self.device_path):
+            return True
+
+        if os.path.isdir('/sys/bus/rbd/devices'):
+            try:
+                for dev_id in os.listdir('/sys/bus/rbd/devices'):
+                    base = '/sys/bus/rbd/devices/%s' % dev_id
+                    if (_read_sysfs(base + '/pool') == self.pool and
+                            _read_sysfs(base + '/name') == self.rbd_image):
+                        self.device_path = '/dev/rbd%s' % dev_id
+                        return True
+                return False
+            except (IOError, OSError) as e:
+                util.SMlog("Failed to read RBD sysfs state: %s" % str(e))
+
+        return self._get_rbd_device_path() is not None
 
     def _map_rbd_image(self):
         """Map the RBD image to a block device"""
         util.SMlog("Mapping RBD image %s" % self.rbd_name)
-        
+
+        # A device path we already know about is a single stat - skip the
+        # showmapped query entirely on the common "already mapped" path
+        # (load() populates device_path when the image was mapped before us)
+        if self.device_path and os.path.exists(self.device_path):
+            util.SMlog("RBD image %s already mapped to %s" % (self.rbd_name, self.device_path))
+            return self.device_path
+
         # Check if already mapped
         device_path = self._get_rbd_device_path()
         if device_path:
@@ -273,14 +469,16 @@ class LVMoRBDSR(LVHDSR.LVHDSR):
                 raise Exception("RBD map returned empty device path")
             
             # Wait for device to be ready
-            if not util.wait_for_path(device_path, 30):
+            if not _wait_for_block_device(device_path, 30):
                 raise Exception("Device %s did not appear" % device_path)
             
             self.device_path = device_path
+            self._cache_device_path(device_path)
             util.SMlog("Successfully mapped RBD image %s to %s" % (self.rbd_name, device_path))
             return device_path
             
         except Exception as e:
+            self._invalidate_device_cache()
             raise xs_errors.XenError('SRUnavailable', 
                                     opterr='Failed to map RBD image %s: %s' % (self.rbd_name, str(e)))
 
@@ -300,9 +498,11 @@ class LVMoRBDSR(LVHDSR.LVHDSR):
             util.pread2(cmd)
             util.SMlog("Successfully unmapped RBD device %s" % self.device_path)
             self.device_path = None
+            self._cache_device_path(None)
         except Exception as e:
             util.SMlog("Warning: Failed to unmap RBD device %s: %s" % (self.device_path, str(e)))
             # Don't raise exception here as this might be called during cleanup
+            self._invalidate_device_cache()
 
     def _ensure_rbd_mapped(self, sr_uuid):
         """Ensure the RBD image is mapped and ready"""
@@ -327,14 +527,18 @@ class LVMoRBDSR(LVHDSR.LVHDSR):
         try:
             # Create RBD image with specified size and XCP-ng compatible features
             # Disable modern features that aren't supported by XCP-ng/Nautilus kernels
-            cmd = self._build_rbd_cmd([
-                'create', 
-                '--size', str(size_mb),  # RBD uses MB
-                '--image-format', '2',  # Use format 2 for advanced features
-                '--image-feature', 'layering',  # Only enable basic layering feature
-                self.rbd_name
-            ])
-            util.pread2(cmd)
+            if self._connect_cluster() is not None:
+                self._rbd.create(self._ioctx, self.rbd_image, size_mb * 1024 * 1024,
+                                 old_format=False, features=librbd.RBD_FEATURE_LAYERING)
+            else:
+                cmd = self._build_rbd_cmd([
+                    'create', 
+                    '--size', str(size_mb),  # RBD uses MB
+                    '--image-format', '2',  # Use format 2 for advanced features
+                    '--image-feature', 'layering',  # Only enable basic layering feature
+                    self.rbd_name
+                ])
+                util.pread2(cmd)
             
             util.SMlog("Successfully created RBD image %s" % self.rbd_name)
             
@@ -352,8 +556,11 @@ class LVMoRBDSR(LVHDSR.LVHDSR):
         util.SMlog("Deleting RBD image %s" % self.rbd_name)
         
         try:
-            cmd = self._build_rbd_cmd(['rm', self.rbd_image, '--pool', self.pool])
-            util.pread2(cmd)
+            if self._connect_cluster() is not None:
+                self._rbd.remove(self._ioctx, self.rbd_image)
+            else:
+                cmd = self._build_rbd_cmd(['rm', self.rbd_image, '--pool', self.pool])
+                util.pread2(cmd)
             util.SMlog("Successfully deleted RBD image %s" % self.rbd_name)
         except Exception as e:
             raise xs_errors.XenError('SRUnavailable',
@@ -384,9 +591,6 @@ class LVMoRBDSR(LVHDSR.LVHDSR):
         # Create the RBD image
         self._create_rbd_image(rbd_size_mb)
         
-        if ('protected' in self.dconf and self.dconf['protected'].lower() == 'false'):
-            self.protected = False
-        
         try:
             # Map the RBD image
             self._ensure_rbd_mapped(sr_uuid)
@@ -428,6 +632,11 @@ class LVMoRBDSR(LVHDSR.LVHDSR):
             util.SMlog("Warning: Failed to export VG %s: %s" % (self.vgname, str(e)))
             raise
 
+    def _deactivate_and_export_vg(self):
+        """Deactivate and export the VG under one LVM config swap"""
+        self._deactivate_vg()
+        self._export_vg()
+
     def delete(self, sr_uuid):
         """Delete the SR - remove LVM volume group and RBD image"""
         util.SMlog("Deleting LVMoRBD SR %s" % sr_uuid)
@@ -438,11 +647,10 @@ class LVMoRBDSR(LVHDSR.LVHDSR):
                 try:
                     util.SMlog("Deactivating and exporting VG for protected RBD image %s" % self.rbd_name)
                     
-                    # Deactivate all LVs in the VG to release locks
-                    self._with_rbd_lvm_conf(self._deactivate_vg)
-                    
-                    # Export the VG to cleanly disconnect from LVM
-                    self._with_rbd_lvm_conf(self._export_vg)
+                    # Deactivate all LVs in the VG to release locks, then
+                    # export it to cleanly disconnect from LVM - both under
+                    # a single environment swap
+                    self._with_rbd_lvm_conf(self._deactivate_and_export_vg)
                     
                     util.SMlog("Successfully deactivated and exported VG for %s" % self.vgname)
                     